@@ -1,22 +1,40 @@
 #!/usr/bin/env python3
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError
+)
 import os
-import tempfile
+import io
 import zipfile
 import tarfile
-import glob
+import fnmatch
 import shutil
+import tempfile
 import fcntl
+import errno
 import hashlib
+import json
+import base64
+import mmap
 import time
+import random
 import sys
 import signal
-import subprocess
+import threading
 from datetime import datetime
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 import schedule
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from contextlib import contextmanager
+from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 加载 .env 文件
@@ -24,26 +42,107 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
 load_dotenv(env_path, override=True)
 
+# Layer ZIP 内文件的固定时间戳，保证 ZIP 字节可复现
+LAYER_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# 可重试的 AWS 错误码（限流、服务端临时错误、函数更新冲突）
+RETRYABLE_AWS_ERROR_CODES = frozenset({
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'ServiceException',
+    'ResourceConflictException',
+})
+
+# Layer 版本列表缓存有效期（秒）
+LAYER_VERSIONS_CACHE_TTL = 60
+
+# 通过 S3 发布 Layer 的最小 ZIP 大小，更小的 ZIP 直接内联上传
+LAYER_S3_MIN_SIZE = 5 * 1024 * 1024
+# Layer ZIP 上传 S3 时分片并发上传
+LAYER_S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4
+)
+
+# /tmp 中需要定期清理的临时文件和目录（文件名模式）
+TEMP_FILE_PATTERNS = [
+    ('*.mmdb', 'MMDB文件'),
+    ('*.tar.gz', 'tar.gz文件'),
+    ('maxmind_*', 'MaxMind文件'),
+    ('backup_*', '备用文件'),
+]
+TEMP_DIR_PATTERNS = ['tmp*', 'geoip_run_*', 'GeoLite2-*', 'GeoIP2-*']
+
+# 下载进度日志间隔（字节）
+DOWNLOAD_PROGRESS_INTERVAL = 10 * 1024 * 1024
+
+# 各操作必须设置的环境变量；AWS_PROFILE、LAMBDA_LAYER_NAME、GEOIP_DOWNLOAD_URL 等有默认值，无需检查
+REQUIRED_ENV_VARS_DEFAULT = frozenset({'AWS_REGIONS'})
+REQUIRED_ENV_VARS = {
+    'update': REQUIRED_ENV_VARS_DEFAULT | {'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'},
+    'schedule': REQUIRED_ENV_VARS_DEFAULT | {'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'},
+}
+
+# AWS 客户端配置：自适应重试、连接池复用、TCP keepalive
+AWS_CLIENT_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    max_pool_connections=32,
+    tcp_keepalive=True
+)
+
+# MMDB 校验：最小文件大小，以及位于文件末尾 128KB 内的元数据起始标记
+MMDB_MIN_SIZE = 1024
+MMDB_METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+MMDB_METADATA_SEARCH_SIZE = 128 * 1024
+
 # 配置日志
 log_file = os.getenv('LOG_FILE', 'geoip_updater.log')
 # 如果是在 Docker 中运行且没有指定绝对路径，默认放到 /var/log
 if os.path.exists('/.dockerenv') and not os.path.isabs(log_file):
     log_file = os.path.join('/var/log', log_file)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# 日志通过队列交给后台线程写入，工作线程记录日志时不阻塞在文件 I/O 上
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler(log_file),
+    logging.StreamHandler(sys.stdout)
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)], format='%(message)s')
+
+@lru_cache(maxsize=None)
+def _get_boto3_session(profile_name):
+    """获取 boto3 Session（进程内复用，避免重复加载凭证和服务模型）"""
+    return boto3.Session(profile_name=profile_name)
+
+@lru_cache(maxsize=None)
+def _get_aws_client(profile_name, service_name, region):
+    """获取AWS客户端（进程内复用，定时任务每次运行无需重新创建）"""
+    return _get_boto3_session(profile_name).client(
+        service_name, region_name=region, config=AWS_CLIENT_CONFIG
+    )
+
+@lru_cache(maxsize=None)
+def _get_lock_fd(lock_file):
+    """获取锁文件描述符（进程内只打开一次，定时任务每次运行共用）"""
+    return os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o644)
 
 class GeoIPUpdater:
     def __init__(self):
         # 基础配置
         self.aws_profile = os.getenv('AWS_PROFILE', 'geoip-updater')
         self.layer_name = os.getenv('LAMBDA_LAYER_NAME', 'GeoLite2')
+        # 匹配函数Layer ARN用，带前后冒号避免 GeoLite2Extra 之类的名称误匹配
+        self._layer_arn_needle = f':layer:{self.layer_name}:'
         
         # 区域配置
         regions_str = os.getenv('AWS_REGIONS', 'us-east-2')
@@ -61,6 +160,9 @@ class GeoIPUpdater:
         self.download_url = os.getenv('GEOIP_DOWNLOAD_URL', 
             'https://ghp.ci/https://raw.githubusercontent.com/P3TERX/GeoLite.mmdb/download/GeoLite2-City.mmdb')
         
+        # Layer 上传配置：配置后较大的 ZIP 先上传到 S3 再发布（桶需与Layer同区域，支持 {region} 占位符）
+        self.layer_s3_bucket = os.getenv('LAYER_S3_BUCKET', '')
+        
         # 网络配置
         self.connection_timeout = int(os.getenv('CONNECTION_TIMEOUT', '15'))
         self.max_time = int(os.getenv('MAX_DOWNLOAD_TIME', '60'))
@@ -68,11 +170,27 @@ class GeoIPUpdater:
         
         # 锁文件和状态
         self.lock_file = '/tmp/geoip_updater.lock'
-        self.lock_fd = None
+        # 记录上次同步时下载源的 ETag/Last-Modified，用于跳过未变化的下载
+        self.state_file = '/tmp/geoip_updater.state.json'
+        # 进程内读写状态文件的互斥；跨进程的互斥由更新锁负责
+        self._state_lock = threading.RLock()
+        # 锁文件描述符在整个进程生命周期内只打开一次（各实例共用），获取/释放只做加解锁
+        self.lock_fd = _get_lock_fd(self.lock_file)
+        self.lock_held = False
         self.should_exit = False
         
-        # 初始化 AWS 客户端
+        # 每次运行的函数列表快照：区域 -> list_functions 返回的函数配置列表
+        self._functions_cache = {}
+        # Layer 版本列表缓存：区域 -> (获取时间, 版本列表)
+        self._layer_versions_cache = {}
+        # 最近一次计算的 ZIP SHA256：(ZIP 内容, CodeSha256)
+        self._zip_sha256_cache = None
+        # 本进程创建的临时文件和目录，运行结束时直接删除
+        self._created_temp_files = set()
+        
+        # 初始化 AWS 客户端和 HTTP 会话
         self._init_aws_clients()
+        self._init_http_session()
         
         # 设置信号处理器
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -83,12 +201,30 @@ class GeoIPUpdater:
 
     def _init_aws_clients(self):
         """初始化AWS客户端"""
-        session = boto3.Session(profile_name=self.aws_profile)
         self.lambda_clients = {}
+        self.s3_clients = {}
         for region in self.regions:
-            self.lambda_clients[region] = session.client('lambda', region_name=region)
+            self.lambda_clients[region] = _get_aws_client(self.aws_profile, 'lambda', region)
+            if self.layer_s3_bucket:
+                self.s3_clients[region] = _get_aws_client(self.aws_profile, 's3', region)
             logging.info(f"已初始化 {region} 区域的 Lambda 客户端")
 
+    def _init_http_session(self):
+        """初始化HTTP会话（连接复用 + 指数退避重试）"""
+        # 连接错误和临时状态码在连接层重试，复用同一连接，无需重新执行整个下载流程
+        retry = Retry(
+            total=self.retry_count,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET', 'HEAD']
+        )
+        # 只会访问少量主机（MaxMind、其重定向的存储地址、备用链接），小连接池即可复用 TCP/TLS 连接
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        self.http = requests.Session()
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.http.headers['User-Agent'] = 'GeoIP-Updater/1.0'
+
     def _signal_handler(self, signum, frame):
         """信号处理器 - 优雅退出"""
         logging.info(f"接收到信号 {signum}，准备退出...")
@@ -98,42 +234,18 @@ class GeoIPUpdater:
 
     def validate_environment(self, action='update'):
         """根据操作类型验证环境变量"""
-        base_vars = {
-            'AWS_PROFILE': self.aws_profile,
-            'LAMBDA_LAYER_NAME': self.layer_name,
-            'AWS_REGIONS': os.getenv('AWS_REGIONS')
-        }
-        
-        action_vars = {
-            'update': {
-                'AWS_ACCESS_KEY_ID': os.getenv('AWS_ACCESS_KEY_ID'),
-                'AWS_SECRET_ACCESS_KEY': os.getenv('AWS_SECRET_ACCESS_KEY')
-            },
-            'schedule': {
-                'AWS_ACCESS_KEY_ID': os.getenv('AWS_ACCESS_KEY_ID'),
-                'AWS_SECRET_ACCESS_KEY': os.getenv('AWS_SECRET_ACCESS_KEY'),
-                'CRON_SCHEDULE': os.getenv('CRON_SCHEDULE', '0 2 * * *'),
-                'TZ': os.getenv('TZ', 'UTC')
-            }
-        }
-        
-        # 合并所需变量
-        required_vars = {**base_vars, **action_vars.get(action, {})}
+        # 使用 MaxMind 直接下载时必须提供账号和许可证
+        if action in ['update', 'schedule'] and self.use_maxmind_direct:
+            if not self.maxmind_account_id or not self.maxmind_license_key:
+                raise EnvironmentError("使用 MaxMind 直接下载时必须提供 MAXMIND_ACCOUNT_ID 和 MAXMIND_LICENSE_KEY")
         
-        # 根据下载方式添加特定变量
-        if action in ['update', 'schedule']:
-            if self.use_maxmind_direct:
-                required_vars.update({
-                    'MAXMIND_ACCOUNT_ID': self.maxmind_account_id,
-                    'MAXMIND_LICENSE_KEY': self.maxmind_license_key
-                })
-                if not self.maxmind_account_id or not self.maxmind_license_key:
-                    raise EnvironmentError("使用 MaxMind 直接下载时必须提供 MAXMIND_ACCOUNT_ID 和 MAXMIND_LICENSE_KEY")
-            else:
-                required_vars['GEOIP_DOWNLOAD_URL'] = self.download_url
+        # Layer 只能从同区域的 S3 桶发布，多区域时桶名必须按区域区分
+        if self.layer_s3_bucket and len(self.regions) > 1 and '{region}' not in self.layer_s3_bucket:
+            raise EnvironmentError("配置多个区域时 LAYER_S3_BUCKET 必须包含 {region} 占位符")
         
-        # 检查缺失的变量
-        missing_vars = [var for var, value in required_vars.items() if not value]
+        # 检查缺失的变量（有默认值的变量无需检查）
+        required_vars = REQUIRED_ENV_VARS.get(action, REQUIRED_ENV_VARS_DEFAULT)
+        missing_vars = sorted(var for var in required_vars if not os.getenv(var))
         if missing_vars:
             raise EnvironmentError(f"缺少必要的环境变量: {', '.join(missing_vars)}")
         
@@ -144,18 +256,23 @@ class GeoIPUpdater:
             self._test_aws_permissions()
 
     def _test_aws_permissions(self):
-        """测试AWS权限"""
-        for region in self.regions:
-            try:
-                lambda_client = self.lambda_clients[region]
-                lambda_client.list_layer_versions(LayerName=self.layer_name)
-                logging.info(f"区域 {region} 权限验证通过")
-            except lambda_client.exceptions.ResourceNotFoundException:
-                logging.info(f"区域 {region} 权限验证通过（Layer尚不存在）")
-            except Exception as e:
-                if 'is not authorized' in str(e):
-                    raise PermissionError(f"区域 {region} 权限不足: {str(e)}")
-                logging.warning(f"区域 {region} 权限测试遇到其他错误: {str(e)}")
+        """测试AWS权限（各区域并发）"""
+        with ThreadPoolExecutor(max_workers=len(self.regions)) as executor:
+            # 遍历结果以便将 PermissionError 抛给调用方
+            list(executor.map(self._test_region_permissions, self.regions))
+
+    def _test_region_permissions(self, region):
+        """测试单个区域的AWS权限"""
+        lambda_client = self.lambda_clients[region]
+        try:
+            self._list_layer_versions(region)
+            logging.info(f"区域 {region} 权限验证通过")
+        except lambda_client.exceptions.ResourceNotFoundException:
+            logging.info(f"区域 {region} 权限验证通过（Layer尚不存在）")
+        except Exception as e:
+            if 'is not authorized' in str(e):
+                raise PermissionError(f"区域 {region} 权限不足: {str(e)}")
+            logging.warning(f"区域 {region} 权限测试遇到其他错误: {str(e)}")
 
     @contextmanager
     def file_lock(self):
@@ -170,148 +287,146 @@ class GeoIPUpdater:
             raise RuntimeError("无法获取更新锁，另一个进程可能正在运行")
 
     def _acquire_lock(self):
-        """获取文件锁"""
+        """获取文件锁（fcntl 记录锁，兼容 NFS 等网络文件系统）"""
         try:
-            self.lock_fd = os.open(self.lock_file, os.O_CREAT | os.O_RDWR)
-            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.lock_held = True
             logging.info("成功获取更新锁")
             return True
-        except IOError:
-            logging.info("另一个进程正在执行更新，跳过当前执行")
-            if self.lock_fd:
-                os.close(self.lock_fd)
-                self.lock_fd = None
-            return False
-        except Exception as e:
-            logging.error(f"获取锁失败: {str(e)}")
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                logging.info("另一个进程正在执行更新，跳过当前执行")
+            else:
+                logging.error(f"获取锁失败: {str(e)}")
             return False
 
     def _release_lock(self):
-        """释放文件锁"""
-        if self.lock_fd is not None:
+        """释放文件锁（保留文件描述符以便下次复用）"""
+        if self.lock_held:
             try:
-                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
-                os.close(self.lock_fd)
-                self.lock_fd = None
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+                self.lock_held = False
                 logging.info("已释放更新锁")
             except Exception as e:
                 logging.error(f"释放锁失败: {str(e)}")
 
     def get_file_hash(self, filepath):
-        """计算文件MD5哈希"""
-        md5_hash = hashlib.md5()
+        """计算文件BLAKE2b哈希（仅用于内容比较）"""
         with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+            
+            # Python < 3.11：mmap 整个文件，一次 update 完成
+            file_hash = hashlib.blake2b(digest_size=16)
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                    file_hash.update(mm)
+            return file_hash.hexdigest()
 
-    def verify_mmdb_file(self, file_path):
-        """验证MMDB文件"""
-        try:
-            file_size = os.path.getsize(file_path)
-            if file_size < 1024:
-                raise ValueError("Downloaded file is too small")
-            logging.info(f"MMDB file verified: {file_size} bytes")
+
+    def _is_retryable_error(self, error):
+        """判断异常是否为可重试的临时错误"""
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code', '')
+            status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            return code in RETRYABLE_AWS_ERROR_CODES or status >= 500
+        if isinstance(error, requests.exceptions.HTTPError):
+            status = error.response.status_code if error.response is not None else 0
+            return status == 429 or status >= 500
+        # 网络连接类错误可重试
+        if isinstance(error, (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
             return True
-        except Exception as e:
-            logging.error(f"File verification failed: {str(e)}")
-            return False
+        # 参数错误、权限不足、文件缺失等其他错误重试也无法恢复
+        return False
 
-    def execute_with_retry(self, operation, max_retries=3, delay=5, *args, **kwargs):
-        """通用重试机制"""
+    def execute_with_retry(self, operation, *args, max_retries=3, base_delay=0.5, max_delay=30, **kwargs):
+        """通用重试机制（指数退避 + 全抖动）"""
         for attempt in range(max_retries):
             try:
                 return operation(*args, **kwargs)
             except Exception as e:
                 logging.warning(f"操作失败 (尝试 {attempt + 1}/{max_retries}): {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(delay)
-                else:
+                if attempt == max_retries - 1 or not self._is_retryable_error(e):
                     raise
+                time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
 
-    def _build_curl_command(self, url, output_path, auth=None, extra_headers=None):
-        """构建curl命令"""
-        cmd = [
-            'curl',
-            '--location',
-            '--fail',
-            '--output', output_path,
-            '--connect-timeout', str(self.connection_timeout),
-            '--max-time', str(self.max_time),
-            '--retry', str(self.retry_count),
-            '--retry-delay', '2',
-            '--progress-bar',
-        ]
-        
-        # 添加认证
-        if auth:
-            cmd.extend(['--user', f'{auth[0]}:{auth[1]}'])
-        
-        # 添加额外头部
-        if extra_headers:
-            for header in extra_headers:
-                cmd.extend(['--header', header])
-        
-        cmd.append(url)
-        return cmd
-
-    def _execute_curl(self, cmd, description="下载"):
-        """执行curl命令并处理结果"""
-        # 隐藏认证信息和AWS URL的日志
-        safe_cmd = []
-        skip_next = False
-        for i, arg in enumerate(cmd):
-            if skip_next:
-                safe_cmd.append('[HIDDEN]')
-                skip_next = False
-            elif arg == '--user':
-                safe_cmd.append(arg)
-                skip_next = True
-            elif arg.startswith('https://') and ('amazonaws.com' in arg or 'awslambda' in arg):
-                safe_cmd.append('[AWS-URL-HIDDEN]')
-            else:
-                safe_cmd.append(arg)
-        
-        logging.info(f"执行{description}: {' '.join(safe_cmd)}")
+    @contextmanager
+    def _http_stream(self, url, description="下载", auth=None):
+        """发起流式GET请求，复用会话连接，响应体按需读取"""
+        logging.info(f"执行{description}: GET {url}")
         
         try:
             start_time = time.time()
             
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=self.max_time + 30,
-                check=False
-            )
+            with self.http.get(
+                url,
+                auth=auth,
+                stream=True,
+                timeout=(self.connection_timeout, self.max_time)
+            ) as response:
+                response.raise_for_status()
+                yield response
             
             elapsed_time = time.time() - start_time
-            
-            if result.returncode != 0:
-                error_msg = result.stderr.strip() if result.stderr else f"curl返回码: {result.returncode}"
-                raise subprocess.CalledProcessError(result.returncode, cmd, stderr=error_msg)
-            
             logging.info(f"{description}完成，耗时: {elapsed_time:.2f}s")
-            return result
             
-        except subprocess.TimeoutExpired:
-            logging.error(f"{description}超时 ({self.max_time + 30}s)")
+        except requests.exceptions.Timeout:
+            logging.error(f"{description}超时")
             raise
-        except subprocess.CalledProcessError as e:
-            logging.error(f"{description}失败: {e.stderr}")
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"{description}失败: {str(e)}")
             raise
         except Exception as e:
             logging.error(f"{description}异常: {str(e)}")
             raise
 
-    def download_mmdb(self):
-        """下载MMDB数据库（统一入口）"""
+    def _copy_stream_to_file(self, src, output_path, is_mmdb=True):
+        """将数据流分块写入文件并同时计算哈希和校验，返回 (写入字节数, 哈希)"""
+        total = 0
+        next_report = DOWNLOAD_PROGRESS_INTERVAL
+        # 与 get_file_hash 使用相同算法，写入时顺带计算，无需再次读取文件
+        file_hash = hashlib.blake2b(digest_size=16)
+        # 保留末尾数据用于查找元数据标记，写完后无需重新打开文件校验
+        tail = b''
+        with open(output_path, 'wb') as dst:
+            while True:
+                chunk = src.read(1 << 20)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                file_hash.update(chunk)
+                total += len(chunk)
+                if len(chunk) >= MMDB_METADATA_SEARCH_SIZE:
+                    tail = chunk[-MMDB_METADATA_SEARCH_SIZE:]
+                else:
+                    tail = (tail + chunk)[-MMDB_METADATA_SEARCH_SIZE:]
+                if total >= next_report:
+                    logging.debug(f"{os.path.basename(output_path)} 已写入 {total / (1 << 20):.0f} MB")
+                    next_report += DOWNLOAD_PROGRESS_INTERVAL
+        
+        if total < MMDB_MIN_SIZE:
+            raise ValueError(f"下载的文件过小: {total} bytes")
+        if is_mmdb:
+            if MMDB_METADATA_MARKER not in tail:
+                raise ValueError("MMDB 文件缺少元数据标记，文件不完整或格式错误")
+            logging.info(f"MMDB 文件校验通过: {total} bytes")
+        return total, file_hash.hexdigest()
+
+    def _write_response_to_file(self, response, output_path, is_mmdb=True):
+        """将响应体分块写入文件，返回 (写入字节数, 哈希)"""
+        response.raw.decode_content = True
+        return self._copy_stream_to_file(response.raw, output_path, is_mmdb)
+
+    def download_mmdb(self, workdir):
+        """下载MMDB数据库（统一入口），返回 (文件路径, 文件哈希)"""
+        # 重试由 HTTP 会话在连接层完成
         if self.use_maxmind_direct:
-            return self.execute_with_retry(self._download_from_maxmind, max_retries=5)
+            return self._download_from_maxmind(workdir)
         else:
-            return self.execute_with_retry(self._download_from_backup, max_retries=3)
+            return self._download_from_backup(workdir)
 
-    def _download_from_maxmind(self):
+    def _download_from_maxmind(self, workdir):
         """从MaxMind官方下载"""
         logging.info(f"从 MaxMind 官方下载 {self.maxmind_edition_id}")
         
@@ -321,35 +436,25 @@ class GeoIPUpdater:
         )
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"maxmind_{self.maxmind_edition_id}_{timestamp}.{self.maxmind_suffix}"
-        downloaded_path = os.path.join('/tmp', filename)
+        if self.maxmind_suffix == 'tar.gz':
+            filename = f"maxmind_{self.maxmind_edition_id}_{timestamp}.mmdb"
+        else:
+            filename = f"maxmind_{self.maxmind_edition_id}_{timestamp}.{self.maxmind_suffix}"
+        downloaded_path = os.path.join(workdir, filename)
         
         try:
-            # 使用curl下载
-            cmd = self._build_curl_command(
-                url=maxmind_url,
-                output_path=downloaded_path,
-                auth=(self.maxmind_account_id, self.maxmind_license_key),
-                extra_headers=['User-Agent: GeoIP-Updater/1.0', 'Accept: */*']
-            )
-            
-            self._execute_curl(cmd, "MaxMind下载")
-            
-            # 验证下载结果
-            if not os.path.exists(downloaded_path):
-                raise FileNotFoundError(f"下载文件不存在: {downloaded_path}")
-            
-            file_size = os.path.getsize(downloaded_path)
-            if file_size < 1024:
-                os.unlink(downloaded_path)
-                raise ValueError(f"下载文件太小: {file_size} bytes")
+            auth = (self.maxmind_account_id, self.maxmind_license_key)
+            with self._http_stream(maxmind_url, "MaxMind下载", auth=auth) as response:
+                if self.maxmind_suffix == 'tar.gz':
+                    # tar.gz 直接从响应流解压，下载与解压同时进行，不落地压缩包
+                    response.raw.decode_content = True
+                    _, mmdb_hash = self._extract_mmdb_from_stream(response.raw, downloaded_path)
+                else:
+                    # 其他格式（如 zip）不是裸 MMDB，只做大小校验
+                    _, mmdb_hash = self._write_response_to_file(response, downloaded_path, is_mmdb=False)
             
             logging.info(f"MaxMind 文件已下载: {downloaded_path}")
-            
-            # 如果是tar.gz，需要解压
-            if self.maxmind_suffix == 'tar.gz':
-                return self._extract_mmdb_from_targz(downloaded_path)
-            return downloaded_path
+            return downloaded_path, mmdb_hash
             
         except Exception as e:
             logging.error(f"MaxMind下载失败: {str(e)}")
@@ -360,34 +465,20 @@ class GeoIPUpdater:
                     pass
             raise
 
-    def _download_from_backup(self):
+    def _download_from_backup(self, workdir):
         """从备用URL下载"""
         logging.info(f"从备用URL下载: {self.download_url}")
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"backup_{timestamp}.mmdb"
-        downloaded_path = os.path.join('/tmp', filename)
+        downloaded_path = os.path.join(workdir, filename)
         
         try:
-            # 使用curl下载
-            cmd = self._build_curl_command(
-                url=self.download_url,
-                output_path=downloaded_path
-            )
-            
-            self._execute_curl(cmd, "备用URL下载")
-            
-            # 验证文件
-            if not os.path.exists(downloaded_path):
-                raise FileNotFoundError(f"下载文件不存在: {downloaded_path}")
-            
-            file_size = os.path.getsize(downloaded_path)
-            if file_size < 1024:
-                os.unlink(downloaded_path)
-                raise ValueError(f"下载文件太小: {file_size} bytes")
+            with self._http_stream(self.download_url, "备用URL下载") as response:
+                _, mmdb_hash = self._write_response_to_file(response, downloaded_path)
             
             logging.info(f"备用链接文件已下载: {downloaded_path}")
-            return downloaded_path
+            return downloaded_path, mmdb_hash
             
         except Exception as e:
             logging.error(f"备用URL下载失败: {str(e)}")
@@ -398,68 +489,56 @@ class GeoIPUpdater:
                     pass
             raise
 
-    def _extract_mmdb_from_targz(self, targz_path):
-        """从tar.gz提取MMDB文件"""
-        logging.info(f"解压 tar.gz 文件: {targz_path}")
+    def _extract_mmdb_from_stream(self, stream, output_path):
+        """从tar.gz数据流中提取MMDB文件，返回 (写入字节数, 哈希)"""
+        # 'r|gz' 为顺序流模式，不需要 seek，可直接读取管道
+        # 只提取与 edition_id 匹配的 .mmdb，COPYRIGHT/LICENSE 等文件直接跳过
+        with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if member.isfile() and name.endswith('.mmdb') and self.maxmind_edition_id in name:
+                    return self._copy_stream_to_file(tar.extractfile(member), output_path)
         
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with tarfile.open(targz_path, 'r:gz') as tar:
-                tar.extractall(temp_dir)
-            
-            # 递归查找MMDB文件
-            mmdb_files = []
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    if file.endswith('.mmdb'):
-                        mmdb_files.append(os.path.join(root, file))
-            
-            if not mmdb_files:
-                raise FileNotFoundError("在解压文件中未找到 .mmdb 文件")
-            
-            # 选择匹配的文件或第一个
-            source_mmdb = mmdb_files[0]
-            for mmdb_file in mmdb_files:
-                if self.maxmind_edition_id in os.path.basename(mmdb_file):
-                    source_mmdb = mmdb_file
-                    break
-            
-            if not self.verify_mmdb_file(source_mmdb):
-                raise ValueError("解压的MMDB文件验证失败")
-            
-            # 复制到新临时文件
-            with tempfile.NamedTemporaryFile(suffix='.mmdb', delete=False) as tmp_file:
-                with open(source_mmdb, 'rb') as src:
-                    shutil.copyfileobj(src, tmp_file)
-                extracted_path = tmp_file.name
-            
-            logging.info(f"MMDB文件已提取: {extracted_path}")
-            return extracted_path
+        raise FileNotFoundError(f"在 tar.gz 文件中未找到 {self.maxmind_edition_id} 的 .mmdb 文件")
 
     def create_layer_zip(self, mmdb_path):
         """创建Layer ZIP文件"""
         logging.info("创建 Layer ZIP 文件")
         
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # 创建目录结构
-            layer_dir = os.path.join(temp_dir, 'python/data')
-            os.makedirs(layer_dir)
-            
-            # 复制MMDB文件
-            dest_file = os.path.join(layer_dir, 'GeoLite2-City.mmdb')
-            shutil.copy2(mmdb_path, dest_file)
-            
-            # 创建ZIP
-            zip_path = os.path.join(temp_dir, 'layer.zip')
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for root, _, files in os.walk(os.path.join(temp_dir, 'python')):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arc_name = os.path.relpath(file_path, temp_dir)
-                        zip_file.write(file_path, arc_name)
-            
-            # 读取ZIP内容
-            with open(zip_path, 'rb') as f:
-                return f.read()
+        # 直接在内存中构建ZIP，不经过临时目录和磁盘回读
+        # 固定时间戳和权限，保证相同MMDB生成相同的ZIP，从而CodeSha256一致
+        zip_info = zipfile.ZipInfo('python/data/GeoLite2-City.mmdb', date_time=LAYER_ZIP_DATE_TIME)
+        zip_info.external_attr = 0o644 << 16
+        
+        if self.layer_s3_bucket:
+            # 通过 S3 发布不受直接上传的50MB限制，MMDB 不压缩，省去压缩和冷启动解压
+            zip_info.compress_type = zipfile.ZIP_STORED
+        else:
+            # MMDB 压缩收益有限，使用最低压缩级别节省CPU，同时保持在直接上传的50MB限制内
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            # ZipFile.open 写入时使用 ZipInfo 上的压缩级别（Python 3.13 之前只有私有属性）
+            if hasattr(zip_info, 'compress_level'):
+                zip_info.compress_level = 1
+            else:
+                zip_info._compresslevel = 1
+        
+        # 按块流式写入，不把整个MMDB读入内存，也不修改源文件
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            with open(mmdb_path, 'rb') as src, zip_file.open(zip_info, 'w') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+        
+        return buffer.getvalue()
+
+    def get_zip_sha256(self, zip_content):
+        """计算ZIP的SHA256（base64），与Lambda返回的 CodeSha256 格式一致"""
+        # 同一份ZIP在各区域检查时共用，只计算一次
+        cached = self._zip_sha256_cache
+        if cached and cached[0] is zip_content:
+            return cached[1]
+        zip_sha256 = base64.b64encode(hashlib.sha256(zip_content).digest()).decode()
+        self._zip_sha256_cache = (zip_content, zip_sha256)
+        return zip_sha256
 
     def execute_lambda_operation(self, operation_name, region, **kwargs):
         """执行Lambda操作的统一接口"""
@@ -467,12 +546,22 @@ class GeoIPUpdater:
         operation = getattr(lambda_client, operation_name)
         return operation(**kwargs)
 
+    def _list_layer_versions(self, region):
+        """获取Layer版本列表（短时缓存，避免同一次运行中重复请求）"""
+        cached = self._layer_versions_cache.get(region)
+        if cached and time.time() - cached[0] < LAYER_VERSIONS_CACHE_TTL:
+            return cached[1]
+        
+        response = self.execute_lambda_operation('list_layer_versions', region, LayerName=self.layer_name)
+        versions = response.get('LayerVersions', [])
+        self._layer_versions_cache[region] = (time.time(), versions)
+        return versions
+
     def get_layer_info(self, region=None):
         """获取Layer信息"""
         region = region or self.primary_region
         try:
-            response = self.execute_lambda_operation('list_layer_versions', region, LayerName=self.layer_name)
-            versions = response.get('LayerVersions', [])
+            versions = self._list_layer_versions(region)
             if versions:
                 latest = versions[0]
                 return {
@@ -486,8 +575,118 @@ class GeoIPUpdater:
             logging.warning(f"区域 {region} 获取Layer信息失败: {str(e)}")
             return None
 
-    def check_update_needed(self, mmdb_path, region=None):
-        """检查是否需要更新 - 优先通过 Description 中的 hash 比较，避免下载整个 Layer"""
+    def _parse_description_value(self, description, key):
+        """从 Layer Description 中提取 'key:value' 字段"""
+        if f'{key}:' not in description:
+            return None
+        return description.split(f'{key}:')[1].split('|')[0].strip()
+
+    def get_maxmind_sha256(self):
+        """获取 MaxMind 为压缩包发布的 SHA256（失败时返回 None）"""
+        sha256_url = (
+            f"https://download.maxmind.com/geoip/databases/{self.maxmind_edition_id}/"
+            f"download?suffix={self.maxmind_suffix}.sha256"
+        )
+        try:
+            response = self.http.get(
+                sha256_url,
+                auth=(self.maxmind_account_id, self.maxmind_license_key),
+                timeout=(self.connection_timeout, self.max_time)
+            )
+            response.raise_for_status()
+            # 格式: "<sha256>  GeoLite2-City_YYYYMMDD.tar.gz"
+            sha256 = response.text.split()[0].lower()
+            if len(sha256) != 64:
+                raise ValueError(f"无效的 SHA256: {sha256}")
+            return sha256
+        except Exception as e:
+            logging.warning(f"获取 MaxMind SHA256 失败: {str(e)}")
+            return None
+
+    def check_source_unchanged(self, source_sha256, region=None):
+        """比较上游 SHA256 与当前 Layer 记录的值，相同则无需下载"""
+        region = region or self.primary_region
+        layer_info = self.get_layer_info(region)
+        if not layer_info:
+            return False
+
+        try:
+            response = self.execute_lambda_operation(
+                'get_layer_version', region,
+                LayerName=self.layer_name,
+                VersionNumber=layer_info['version']
+            )
+            existing_sha256 = self._parse_description_value(response.get('Description', ''), 'source_sha256')
+            return existing_sha256 == source_sha256
+        except Exception as e:
+            logging.warning(f"区域 {region} 读取 Layer 源 SHA256 失败: {str(e)}")
+            return False
+
+    def _load_state(self):
+        """读取状态文件（不存在或损坏时返回空字典）"""
+        with self._state_lock:
+            try:
+                with open(self.state_file, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return {}
+
+    def _save_state(self, state):
+        """原子写入状态文件（先写临时文件并落盘，再替换）"""
+        tmp_path = f"{self.state_file}.tmp"
+        with self._state_lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_file)
+
+    def get_remote_fingerprint(self):
+        """通过 HEAD 请求获取备用链接的 ETag/Last-Modified（失败或无缓存头时返回 None）"""
+        try:
+            response = self.http.head(
+                self.download_url,
+                allow_redirects=True,
+                timeout=(self.connection_timeout, self.max_time)
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logging.warning(f"获取下载源信息失败: {str(e)}")
+            return None
+
+        fingerprint = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_length': response.headers.get('Content-Length'),
+        }
+        if not fingerprint['etag'] and not fingerprint['last_modified']:
+            return None
+        return fingerprint
+
+    def check_fingerprint_unchanged(self, fingerprint):
+        """下载源信息与上次同步时一致，且主区域 Layer 未被改动，则无需下载"""
+        state = self._load_state()
+        if state.get('url') != self.download_url or state.get('fingerprint') != fingerprint:
+            return False
+        layer_info = self.get_layer_info(self.primary_region)
+        return bool(layer_info) and state.get('layer_version_arn') == layer_info['arn']
+
+    def _record_fingerprint(self, fingerprint):
+        """主区域 Layer 与下载源一致后，记录下载源信息"""
+        layer_info = self.get_layer_info(self.primary_region)
+        if not layer_info:
+            return
+        try:
+            self._save_state({
+                'url': self.download_url,
+                'fingerprint': fingerprint,
+                'layer_version_arn': layer_info['arn'],
+            })
+        except Exception as e:
+            logging.warning(f"写入状态文件失败: {str(e)}")
+
+    def check_update_needed(self, mmdb_path, region=None, zip_content=None, mmdb_hash=None):
+        """检查是否需要更新 - 优先比较 CodeSha256，其次比较 Description 中的 hash，避免下载整个 Layer"""
         region = region or self.primary_region
         layer_info = self.get_layer_info(region)
 
@@ -502,12 +701,20 @@ class GeoIPUpdater:
                 VersionNumber=layer_info['version']
             )
 
+            # 最快路径：ZIP 内容确定，CodeSha256 相同即内容相同
+            # 先比较 CodeSize，大小不同时 ZIP 必然不同，无需计算 SHA256
+            content = response.get('Content', {})
+            if (zip_content is not None and content.get('CodeSize') == len(zip_content)
+                    and content.get('CodeSha256') == self.get_zip_sha256(zip_content)):
+                logging.info(f"区域 {region} Layer CodeSha256 相同，无需更新")
+                return False
+
             description = response.get('Description', '')
-            new_hash = self.get_file_hash(mmdb_path)
+            new_hash = mmdb_hash or self.get_file_hash(mmdb_path)
 
             # ✅ 优先路径：从 Description 提取 hash，无需下载 Layer
-            if 'mmdb_hash:' in description:
-                existing_hash = description.split('mmdb_hash:')[1].split('|')[0].strip()
+            existing_hash = self._parse_description_value(description, 'mmdb_hash')
+            if existing_hash:
                 if existing_hash == new_hash:
                     logging.info(
                         f"区域 {region} MMDB hash 相同 "
@@ -533,22 +740,48 @@ class GeoIPUpdater:
             logging.warning(f"区域 {region} 检查更新失败: {str(e)}，执行更新")
             return True
 
-    def update_layer_version(self, zip_content, region, mmdb_hash=None):
+    def _stage_layer_zip(self, zip_content, region):
+        """将Layer ZIP上传到S3暂存，返回 (bucket, key)；未配置或ZIP较小时返回 None"""
+        if not self.layer_s3_bucket or len(zip_content) < LAYER_S3_MIN_SIZE:
+            return None
+        
+        bucket = self.layer_s3_bucket.format(region=region)
+        # key 中包含区域，避免多个区域共用桶时相互覆盖或删除对方的暂存文件
+        key = f"layers/{self.layer_name}_{region}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        self.s3_clients[region].upload_fileobj(
+            io.BytesIO(zip_content), bucket, key, Config=LAYER_S3_TRANSFER_CONFIG
+        )
+        logging.info(f"区域 {region} Layer ZIP 已上传到 s3://{bucket}/{key}")
+        return bucket, key
+
+    def update_layer_version(self, zip_content, region, mmdb_hash=None, source_sha256=None):
         """更新单个区域的Layer版本"""
+        staged = None
         try:
             description = f'GeoIP updated at {datetime.now().isoformat()} for {region}'
             if mmdb_hash:
                 description += f' | mmdb_hash:{mmdb_hash}'  # 写入 hash
+            if source_sha256:
+                description += f' | source_sha256:{source_sha256}'  # 写入上游压缩包 SHA256
 
-            response = self.execute_lambda_operation(
-                'publish_layer_version', region,
+            # 优先通过 S3 发布，避免在 API 请求体中内联（base64 编码的）整个 ZIP
+            staged = self._stage_layer_zip(zip_content, region)
+            if staged:
+                content = {'S3Bucket': staged[0], 'S3Key': staged[1]}
+            else:
+                content = {'ZipFile': zip_content}
+
+            response = self.execute_with_retry(
+                self.execute_lambda_operation, 'publish_layer_version', region,
                 LayerName=self.layer_name,
                 Description=description,
-                Content={'ZipFile': zip_content},
+                Content=content,
                 CompatibleRuntimes=['python3.8', 'python3.9', 'python3.10', 'python3.12'],
                 CompatibleArchitectures=['x86_64', 'arm64']
             )
 
+            # 新版本已发布，版本列表缓存失效
+            self._layer_versions_cache.pop(region, None)
             logging.info(f"区域 {region} Layer更新成功，版本: {response['Version']}")
             return {
                 'status': 'success',
@@ -558,26 +791,38 @@ class GeoIPUpdater:
         except Exception as e:
             logging.error(f"区域 {region} Layer更新失败: {str(e)}")
             return {'status': 'failed', 'error': str(e)}
+        finally:
+            # Lambda 发布时已复制 S3 对象，暂存文件可以删除
+            if staged:
+                try:
+                    self.s3_clients[region].delete_object(Bucket=staged[0], Key=staged[1])
+                except Exception as e:
+                    logging.warning(f"区域 {region} 删除暂存 Layer ZIP 失败: {str(e)}")
 
     def update_functions_using_layer(self, layer_version_arn, region):
         """更新使用指定Layer的所有函数"""
         try:
             updated_functions = []
-            paginator = self.lambda_clients[region].get_paginator('list_functions')
             
-            for page in paginator.paginate():
-                for function in page['Functions']:
-                    function_name = function['FunctionName']
-                    
-                    # 获取函数配置
-                    config = self.execute_lambda_operation(
-                        'get_function_configuration', region,
-                        FunctionName=function_name
-                    )
-                    
-                    # 检查并更新Layer
-                    if self._update_function_layer(function_name, layer_version_arn, config, region):
-                        updated_functions.append(function_name)
+            # 快照中只包含引用了该Layer的函数，条目直接作为配置使用
+            functions = self._get_functions(region)
+            if not functions:
+                logging.info(f"区域 {region} 没有函数使用Layer {self.layer_name}")
+                return updated_functions
+            
+            # 并发更新函数配置，并发数受 Lambda 控制面写操作限制
+            with ThreadPoolExecutor(max_workers=min(10, len(functions))) as executor:
+                future_to_function = {
+                    executor.submit(
+                        self._update_function_layer,
+                        function['FunctionName'], layer_version_arn, function, region
+                    ): function['FunctionName']
+                    for function in functions
+                }
+                
+                for future in as_completed(future_to_function):
+                    if future.result():
+                        updated_functions.append(future_to_function[future])
             
             logging.info(f"区域 {region} 已更新 {len(updated_functions)} 个函数的Layer版本")
             return updated_functions
@@ -593,7 +838,7 @@ class GeoIPUpdater:
         has_geolite2 = False
         
         for layer in current_layers:
-            if f':layer:{self.layer_name}:' in layer['Arn']:
+            if self._layer_arn_needle in layer['Arn']:
                 new_layers.append(new_layer_arn)
                 has_geolite2 = True
                 logging.info(f"区域 {region} 函数 {function_name} 更新Layer: {layer['Arn']} -> {new_layer_arn}")
@@ -609,6 +854,8 @@ class GeoIPUpdater:
                 FunctionName=function_name,
                 Layers=new_layers
             )
+            # 同步更新函数快照，保证后续清理判断使用最新的Layer引用
+            config['Layers'] = [{'Arn': arn} for arn in new_layers]
             return True
         except Exception as e:
             logging.error(f"区域 {region} 更新函数 {function_name} 配置失败: {str(e)}")
@@ -617,21 +864,25 @@ class GeoIPUpdater:
     def cleanup_old_layer_versions(self, region, keep_latest_n=2):
         """清理旧的Layer版本"""
         try:
-            response = self.execute_lambda_operation('list_layer_versions', region, LayerName=self.layer_name)
-            versions = response.get('LayerVersions', [])
+            versions = self._list_layer_versions(region)
             
             if len(versions) <= keep_latest_n:
                 return
             
-            versions.sort(key=lambda x: x['Version'], reverse=True)
+            versions = sorted(versions, key=lambda x: x['Version'], reverse=True)
             versions_to_check = versions[keep_latest_n:]
             
+            # 一次遍历函数快照得到所有在用的Layer版本，避免每个版本重复扫描
+            in_use_arns = self._get_layer_versions_in_use(region)
+            if in_use_arns is None:
+                return
+            
             for version in versions_to_check:
                 version_arn = version['LayerVersionArn']
                 version_number = version['Version']
                 
                 # 检查是否有函数在使用
-                if not self._is_layer_version_in_use(version_arn, region):
+                if version_arn not in in_use_arns:
                     try:
                         self.execute_lambda_operation(
                             'delete_layer_version', region,
@@ -645,79 +896,92 @@ class GeoIPUpdater:
         except Exception as e:
             logging.error(f"区域 {region} 清理Layer版本失败: {str(e)}")
 
-    def _is_layer_version_in_use(self, layer_version_arn, region):
-        """检查Layer版本是否被使用"""
-        try:
+    def _get_functions(self, region):
+        """获取区域内引用该Layer的函数列表快照（每次运行只分页扫描一次，更新函数与清理版本共用）"""
+        if region not in self._functions_cache:
+            # list_functions 返回的条目已包含 Layers，用 JMESPath 在分页时直接筛选
             paginator = self.lambda_clients[region].get_paginator('list_functions')
-            for page in paginator.paginate():
-                for function in page['Functions']:
-                    config = self.execute_lambda_operation(
-                        'get_function_configuration', region,
-                        FunctionName=function['FunctionName']
-                    )
-                    if 'Layers' in config:
-                        if any(layer['Arn'] == layer_version_arn for layer in config['Layers']):
-                            return True
-            return False
-        except Exception:
-            return True  # 如果检查失败，保守起见认为在使用
+            self._functions_cache[region] = list(paginator.paginate().search(
+                f"Functions[?Layers[?contains(Arn, '{self._layer_arn_needle}')]]"
+            ))
+        return self._functions_cache[region]
+
+    def _get_layer_versions_in_use(self, region):
+        """获取区域内被函数引用的Layer版本ARN集合"""
+        try:
+            return {
+                layer['Arn']
+                for function in self._get_functions(region)
+                for layer in function.get('Layers', [])
+            }
+        except Exception as e:
+            # 如果检查失败，保守起见不删除任何版本
+            logging.warning(f"区域 {region} 获取Layer使用情况失败，跳过版本清理: {str(e)}")
+            return None
+
+    def _remove_created_temp_files(self):
+        """删除本次运行创建的临时文件和目录"""
+        while self._created_temp_files:
+            path = self._created_temp_files.pop()
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
 
     def cleanup_temp_files(self, after_update=False):
-        """清理临时文件"""
+        """清理临时文件（单次扫描 /tmp，匹配所有文件和目录模式）"""
         current_time = time.time()
         age_threshold = 3600 if after_update else 24 * 3600  # 1小时或24小时
         
-        patterns = [
-            ('/tmp/*.mmdb', 'MMDB文件'),
-            ('/tmp/*.tar.gz', 'tar.gz文件'),
-            ('/tmp/maxmind_*', 'MaxMind文件'),
-            ('/tmp/backup_*', '备用文件')
-        ]
-        
-        for pattern, file_type in patterns:
-            self._cleanup_files_by_pattern(pattern, age_threshold, file_type)
-        
-        # 清理临时目录
-        self._cleanup_temp_directories(age_threshold)
-
-    def _cleanup_files_by_pattern(self, pattern, age_threshold, file_type):
-        """按模式清理文件"""
-        files = glob.glob(pattern)
-        current_time = time.time()
-        
-        for file_path in files:
-            try:
-                if current_time - os.path.getmtime(file_path) > age_threshold:
-                    os.remove(file_path)
-                    logging.info(f"已删除过期{file_type}: {file_path}")
-            except Exception as e:
-                logging.warning(f"删除{file_type} {file_path} 失败: {str(e)}")
-
-    def _cleanup_temp_directories(self, age_threshold):
-        """清理临时目录"""
-        temp_patterns = ['/tmp/tmp*', '/tmp/GeoLite2-*', '/tmp/GeoIP2-*']
-        current_time = time.time()
+        try:
+            entries = os.scandir('/tmp')
+        except OSError as e:
+            logging.warning(f"扫描临时目录失败: {str(e)}")
+            return
         
-        for pattern in temp_patterns:
-            for dir_path in glob.glob(pattern):
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
                 try:
-                    if os.path.isdir(dir_path):
-                        if current_time - os.path.getmtime(dir_path) > age_threshold:
-                            shutil.rmtree(dir_path)
-                            logging.info(f"已删除过期目录: {dir_path}")
+                    if entry.is_dir(follow_symlinks=False):
+                        if not any(fnmatch.fnmatch(entry.name, p) for p in TEMP_DIR_PATTERNS):
+                            continue
+                        # DirEntry 缓存 stat 结果，无需额外的 getmtime 调用
+                        if current_time - entry.stat(follow_symlinks=False).st_mtime > age_threshold:
+                            shutil.rmtree(entry.path)
+                            logging.info(f"已删除过期目录: {entry.path}")
+                    else:
+                        file_type = next(
+                            (t for p, t in TEMP_FILE_PATTERNS if fnmatch.fnmatch(entry.name, p)), None
+                        )
+                        if file_type is None:
+                            continue
+                        if current_time - entry.stat(follow_symlinks=False).st_mtime > age_threshold:
+                            os.remove(entry.path)
+                            logging.info(f"已删除过期{file_type}: {entry.path}")
                 except Exception as e:
-                    logging.warning(f"删除目录 {dir_path} 失败: {str(e)}")
+                    logging.warning(f"删除临时文件 {entry.path} 失败: {str(e)}")
 
-    def update_all_regions(self, mmdb_path):
-        """更新所有区域"""
-        zip_content = self.create_layer_zip(mmdb_path)
-        mmdb_hash = self.get_file_hash(mmdb_path)  # 计算一次，所有区域共用
+    def update_all_regions(self, mmdb_path, zip_content=None, source_sha256=None, skip_unchanged=False,
+                           mmdb_hash=None):
+        """更新所有区域（skip_unchanged 时各区域并发检查，已是最新的区域跳过）"""
+        if zip_content is None:
+            zip_content = self.create_layer_zip(mmdb_path)
+        self._functions_cache = {}
+        if mmdb_hash is None:
+            mmdb_hash = self.get_file_hash(mmdb_path)  # 计算一次，所有区域共用
         results = {}
 
         with ThreadPoolExecutor(max_workers=min(len(self.regions), 5)) as executor:
             future_to_region = {
                 executor.submit(
-                    self._update_single_region, region, zip_content, mmdb_hash
+                    self._update_single_region, region, zip_content, mmdb_hash, source_sha256,
+                    # 主区域已在 update_layer 中检查过
+                    skip_unchanged and region != self.primary_region
                 ): region
                 for region in self.regions
             }
@@ -733,10 +997,13 @@ class GeoIPUpdater:
         self._log_update_results(results)
         return results
 
-    def _update_single_region(self, region, zip_content, mmdb_hash=None):
-        """更新单个区域的完整流程"""
+    def _update_single_region(self, region, zip_content, mmdb_hash=None, source_sha256=None, check_unchanged=False):
+        """更新单个区域的完整流程（check_unchanged 时先检查该区域是否需要更新）"""
         try:
-            layer_result = self.update_layer_version(zip_content, region, mmdb_hash)
+            if check_unchanged and not self.check_update_needed(None, region, zip_content=zip_content, mmdb_hash=mmdb_hash):
+                return {'status': 'skipped', 'reason': 'no_update_needed'}
+
+            layer_result = self.update_layer_version(zip_content, region, mmdb_hash, source_sha256)
             if layer_result['status'] != 'success':
                 return layer_result
 
@@ -775,36 +1042,67 @@ class GeoIPUpdater:
                 # 清理旧文件
                 self.cleanup_temp_files(after_update=False)
                 
+                # MaxMind 为每个压缩包发布 SHA256，与 Layer 记录一致时无需下载
+                source_sha256 = self.get_maxmind_sha256() if self.use_maxmind_direct else None
+                if not force_update and source_sha256 and self.check_source_unchanged(source_sha256):
+                    logging.info(f"MaxMind 数据库未变化 ({source_sha256[:8]}...)，跳过下载和所有区域")
+                    results = {region: {'status': 'skipped', 'reason': 'source_unchanged'}
+                            for region in self.regions}
+                    self._log_update_results(results)
+                    return results
+                
+                # 备用链接：ETag/Last-Modified 与上次同步时一致则无需下载
+                fingerprint = None if self.use_maxmind_direct else self.get_remote_fingerprint()
+                if not force_update and fingerprint and self.check_fingerprint_unchanged(fingerprint):
+                    logging.info("下载源未变化，跳过下载和所有区域")
+                    results = {region: {'status': 'skipped', 'reason': 'source_unchanged'}
+                            for region in self.regions}
+                    self._log_update_results(results)
+                    return results
+                
+                # 本次运行的工作目录，所有下载/解压文件都放在这里，结束时整体删除
+                workdir = tempfile.mkdtemp(prefix='geoip_run_', dir='/tmp')
+                self._created_temp_files.add(workdir)
                 try:
                     # 下载数据库
-                    mmdb_path = self.download_mmdb()
+                    # 哈希在下载过程中已计算，无需再次读取文件
+                    mmdb_path, mmdb_hash = self.download_mmdb(workdir)
                     logging.info(f"成功下载数据库: {mmdb_path}")
                     
+                    # 构建一次 Layer ZIP，检查与更新共用
+                    zip_content = self.create_layer_zip(mmdb_path)
+                    
                     # 检查是否需要更新
-                    if not force_update and not self.check_update_needed(mmdb_path, self.primary_region):
+                    if not force_update and not self.check_update_needed(
+                            mmdb_path, self.primary_region,
+                            zip_content=zip_content, mmdb_hash=mmdb_hash):
                         logging.info("主区域无需更新，跳过所有区域")
                         results = {region: {'status': 'skipped', 'reason': 'no_update_needed'} 
                                 for region in self.regions}
                         self._log_update_results(results)
                         
-                        # 清理下载的文件
-                        os.unlink(mmdb_path)
-                        self.cleanup_temp_files(after_update=True)
+                        if fingerprint:
+                            self._record_fingerprint(fingerprint)
+                        
                         return results
                     
                     # 执行更新
-                    results = self.update_all_regions(mmdb_path)
+                    # 主区域需要更新时，其余区域在各自线程中并发检查，已是最新的区域跳过
+                    results = self.update_all_regions(
+                        mmdb_path, zip_content, source_sha256,
+                        skip_unchanged=not force_update, mmdb_hash=mmdb_hash)
                     
-                    # 清理临时文件
-                    os.unlink(mmdb_path)
-                    self.cleanup_temp_files(after_update=True)
+                    if fingerprint and results.get(self.primary_region, {}).get('status') == 'success':
+                        self._record_fingerprint(fingerprint)
                     
                     return results
                     
                 except Exception as e:
                     logging.error(f"下载或更新过程失败: {str(e)}")
-                    self.cleanup_temp_files(after_update=True)
                     raise
+                finally:
+                    # 只删除本次运行创建的文件，无需再扫描 /tmp
+                    self._remove_created_temp_files()
                     
         except KeyboardInterrupt:
             logging.info("检测到手动中断，程序退出")
@@ -822,8 +1120,6 @@ def update_job():
         logging.info("定时更新任务完成")
     except Exception as e:
         logging.error(f"定时更新任务失败: {str(e)}")
-    finally:
-        updater.cleanup_temp_files(after_update=False)
 
 def main():
     """主函数"""
@@ -868,11 +1164,14 @@ def main():
             schedule.every().day.at("02:00").do(update_job)
             update_job()  # 首次执行
             
-            while True:
-                schedule.run_pending()
-                time.sleep(60)
-                if updater.should_exit:
+            # 按下一次任务的时间计算休眠时长，而不是每分钟轮询；最长休眠1小时
+            while not updater.should_exit:
+                idle = schedule.idle_seconds()
+                if idle is None:
                     break
+                if idle > 0:
+                    time.sleep(min(idle, 3600))
+                schedule.run_pending()
                     
     except KeyboardInterrupt:
         logging.info("用户中断，程序退出")